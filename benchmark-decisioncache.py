@@ -0,0 +1,84 @@
+# -*- encoding: utf-8 -*-
+#
+# This file is part of wsgicors
+#
+# wsgicors is a WSGI middleware that answers CORS preflight requests
+#
+# copyright 2014-2015 Norman Krämer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares policy lookups for a growing number of threads through
+
+- CORS.lruSelectPolicy, the lru_cache wsgicors uses with the GIL enabled
+- CORS.shardedSelectPolicy, the DecisionCache wsgicors uses on free threaded python
+
+in two scenarios: "hits" looks up 100 origins over and over, "churn" mostly
+origins that aren't cached, as with bots sending random origins.
+
+Usage: python benchmark-decisioncache.py [lookups per thread]
+
+Scaling beyond one thread is only to be expected on a free threaded python."""
+
+from __future__ import print_function
+import sys
+import threading
+import time
+
+from wsgicors import CORS, DecisionCache, DECISION_CACHE_SIZE
+
+cfg = {"policy":"pol2,pol1",
+       "pol1_origin":"*",
+       "pol1_methods":"*",
+       "pol2_origin":"https://*.woopy.com http://localhost:*",
+       "pol2_methods":"*",
+       }
+
+scenarios = [("hits", ["https://host%d.woopy.com" % i for i in range(50)] + ["http://localhost:%d" % (8000 + i) for i in range(50)]),
+             ("churn", ["https://host%d.palim.com" % i for i in range(50 * DECISION_CACHE_SIZE)])]
+
+def run(select, origins, threads, lookups):
+    start = threading.Event()
+    n = len(origins)
+
+    def work(offset):
+        start.wait()
+        for i in range(lookups):
+            select(origins[(offset + i * 7) % n], "GET")
+
+    workers = [threading.Thread(target=work, args=(i * n // threads,)) for i in range(threads)]
+    for w in workers:
+        w.start()
+    t0 = time.time()
+    start.set()
+    for w in workers:
+        w.join()
+    return threads * lookups / (time.time() - t0)
+
+def main():
+    lookups = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print("python %s, GIL %s" % (sys.version.split()[0], "enabled" if gil else "disabled"))
+    for name, origins in scenarios:
+        print("")
+        print("%s, lookups/s" % name)
+        print("%8s %16s %16s" % ("threads", "lru_cache", "DecisionCache"))
+        for threads in (1, 2, 4, 8, 16, 32):
+            corsed = CORS(None, cfg)
+            lru = run(corsed.lruSelectPolicy, origins, threads, lookups)
+            corsed.decisions = DecisionCache()
+            sharded = run(corsed.shardedSelectPolicy, origins, threads, lookups)
+            print("%8d %16d %16d" % (threads, lru, sharded))
+
+if __name__ == "__main__":
+    main()
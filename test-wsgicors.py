@@ -18,8 +18,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import os
+import tempfile
+import wsgicors
 from webob import Request, Response
 from wsgicors import make_middleware as mw
+from wsgicors import CORS, OriginIndex, DecisionCache
 from nose import with_setup
 
 deny = {"policy":"deny"}
@@ -110,6 +115,193 @@ def test_selectPolicy_verbmatch():
     policyname, ret_origin = corsed.selectPolicy("ourdomain", "PUT")
     assert policyname == "pol1", "'pol1' should have been returned since it matches both origin and verb first (but result was: '%s')" % policyname
     
+@with_setup(setup)
+def test_snapshot_roundtrip():
+    "policies loaded from a snapshot equal the compiled ones"
+    fd, snapfile = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        compiled = mw(Response("this is not a preflight response"), multi)
+        compiled.saveSnapshot(snapfile)
+
+        # tamper with the snapshot to see that it is really used
+        with open(snapfile) as f:
+            snap = json.load(f)
+        snap["policies"][0]["maxage"] = "42"
+        with open(snapfile, "w") as f:
+            json.dump(snap, f)
+
+        cfg = multi.copy()
+        cfg["snapshot"] = snapfile
+        loaded = mw(Response("this is not a preflight response"), cfg)
+        assert loaded.policies["pol2"].maxage == "42", "snapshot should have been used (but maxage was: '%s')" % loaded.policies["pol2"].maxage
+        assert loaded.policies["pol1"] == compiled.policies["pol1"], "loaded policy differs from compiled one"
+
+        policyname, ret_origin = loaded.selectPolicy("palim.woopy.com")
+        assert policyname == "pol2", "'pol2' should have been returned since it matches first (but result was: '%s')" % policyname
+    finally:
+        os.remove(snapfile)
+
+@with_setup(setup)
+def test_snapshot_skips_parsing():
+    "loading a snapshot doesn't parse any origin pattern"
+    fd, snapfile = tempfile.mkstemp()
+    os.close(fd)
+    cfg = multi.copy()
+    cfg["pol2_origin"] = "https://*.woopy.com http://localhost:8080 *palim.com"
+    mw(Response("this is not a preflight response"), cfg).saveSnapshot(snapfile)
+
+    def fail(*args, **kw):
+        raise AssertionError("origin patterns should not be parsed when loading a snapshot")
+
+    saved = wsgicors.splitOrigin, wsgicors.addHost, wsgicors.OriginIndex.add
+    wsgicors.splitOrigin = wsgicors.addHost = wsgicors.OriginIndex.add = fail
+    try:
+        cfg["snapshot"] = snapfile
+        loaded = mw(Response("this is not a preflight response"), cfg)
+    finally:
+        wsgicors.splitOrigin, wsgicors.addHost, wsgicors.OriginIndex.add = saved
+        os.remove(snapfile)
+
+    for origin, expected in [("https://a.woopy.com", "pol2"), ("http://localhost:8080", "pol2"),
+                             ("https://palim.com", "pol2"), ("http://localhost:8081", "pol1")]:
+        policyname, ret_origin = loaded.selectPolicy(origin)
+        assert policyname == expected, "'%s' should have been returned for %s (but result was: '%s')" % (expected, origin, policyname)
+
+@with_setup(setup)
+def test_snapshot_fingerprint_mismatch():
+    "a snapshot of a different configuration is ignored"
+    fd, snapfile = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        mw(Response("this is not a preflight response"), multi).saveSnapshot(snapfile)
+
+        cfg = multi.copy()
+        cfg["pol2_maxage"] = "42"
+        cfg["snapshot"] = snapfile
+        loaded = mw(Response("this is not a preflight response"), cfg)
+        assert loaded.policies["pol2"].maxage == "42", "configuration should have been compiled (but maxage was: '%s')" % loaded.policies["pol2"].maxage
+
+        cfg["snapshot"] = snapfile + ".missing"
+        loaded = mw(Response("this is not a preflight response"), cfg)
+        assert loaded.policies["pol2"].maxage == "42", "configuration should have been compiled (but maxage was: '%s')" % loaded.policies["pol2"].maxage
+    finally:
+        os.remove(snapfile)
+
+@with_setup(setup)
+def test_snapshot_malformed():
+    "a snapshot of the wrong shape is ignored"
+    fd, snapfile = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        compiled = mw(Response("this is not a preflight response"), multi)
+        compiled.saveSnapshot(snapfile)
+        with open(snapfile) as f:
+            snap = json.load(f)
+
+        extra = json.loads(json.dumps(snap))
+        extra["policies"][0]["palim"] = "palim"
+        missing = json.loads(json.dumps(snap))
+        del missing["policies"][0]["maxage"]
+        notall = json.loads(json.dumps(snap))
+        del notall["policies"][0]
+        nomatcher = json.loads(json.dumps(snap))
+        del nomatcher["matchers"]["pol1"]
+        badtries = []
+        for hosts in ([[None, None, "x"]], [[None, None, {"woopy": []}]], [[None, None, {".globs": [["*", "x"]]}]],
+                      [[None, None, {".globs": "x"}]], [[None, None, {".": 1}]], [[1, None, {}]], [[None, None]]):
+            badtrie = json.loads(json.dumps(snap))
+            badtrie["matchers"]["pol2"]["hosts"] = hosts
+            badtries.append(badtrie)
+
+        cfg = multi.copy()
+        cfg["snapshot"] = snapfile
+        for malformed in [[snap], {"fingerprint": snap["fingerprint"]}, extra, missing, notall, nomatcher] + badtries:
+            with open(snapfile, "w") as f:
+                json.dump(malformed, f)
+            loaded = mw(Response("this is not a preflight response"), cfg)
+            assert loaded.policies == compiled.policies, "configuration should have been compiled for snapshot %r" % (malformed, )
+            policyname, ret_origin = loaded.selectPolicy("palim.woopy.com")
+            assert policyname == "pol2", "'pol2' should have been returned for snapshot %r (but result was: '%s')" % (malformed, policyname)
+    finally:
+        os.remove(snapfile)
+
+@with_setup(setup)
+def test_origin_index():
+    "origins are matched on scheme, host labels and port"
+    for pattern, origin, expected in [("https://*.example.com", "https://a.example.com", True),
+                                      ("https://*.example.com", "https://a.b.example.com", True),
+                                      ("https://*.example.com", "https://example.com", False),
+                                      ("https://*.example.com", "https://evil.example.com.attacker.net", False),
+                                      ("https://*.example.com", "http://a.example.com", False),
+                                      ("https://*.example.com", "https://a.example.com:443", False),
+                                      ("https://*.example.com", "https://a.example.com:8443", False),
+                                      ("https://*.example.com:*", "https://a.example.com:8443", True),
+                                      ("https://*.example.com:*", "https://a.example.com", False),
+                                      ("http://api.*.example.com", "http://api.eu.example.com", True),
+                                      ("http://api.*.example.com", "http://api.eu.west.example.com", False),
+                                      ("http://api-?.example.com", "http://api-1.example.com", True),
+                                      ("http://localhost:8080", "HTTP://LocalHost:8080", True),
+                                      ("http://[::1]:8080", "http://[::1]:8080", True),
+                                      ("*.woopy.com", "https://palim.woopy.com", True),
+                                      ("*.woopy.com", "palim.woopy.com", True),
+                                      ("*woopy.com", "https://palim.woopy.com", True),
+                                      ("localhost:8080", "http://localhost:8080", False),
+                                      ("localhost:8080", "localhost:8080", True),
+                                      ("http://[::1]", "http://[::1]:80", False),
+                                      ("example.com", "https://example.com.", False),
+                                      ("https://example.com", "https://example.com.", False),
+                                      ("http*://woopy.com", "https://woopy.com", True),
+                                      ("*:*", "https://example.com", True),
+                                      ("*:*", "https://a.example.org:8443", True),
+                                      ("https://*", "https://a.example.org:8443", True),
+                                      ("https://*.example.*", "https://a.example.com", True),
+                                      ("https://*.example.*", "https://a.example.com:8443", False),
+                                      ("https://*.example.*", "https://a.example.com.attacker.net", False),
+                                      ]:
+        yield origin_index_match, pattern, origin, expected
+
+def origin_index_match(pattern, origin, expected):
+    result = OriginIndex([pattern]).match(origin)
+    assert result == expected, "Matching '%s' against '%s': expected %s but got %s" % (origin, pattern, expected, result)
+
+@with_setup(setup)
+def test_decision_cache():
+    "the decision cache is bounded and keeps the decisions"
+    cache = DecisionCache(maxsize=8, shards=4)
+    for i in range(100):
+        assert cache.put(("origin%d" % i, None), i) == i
+        assert cache.get(("origin%d" % i, None)) == i, "freshly inserted entry must be found"
+    assert len(cache) <= 8, "cache should hold at most 8 entries but has %s" % len(cache)
+
+    for kw in ({"maxsize": 0}, {"shards": 0}, {"shards": 3}):
+        try:
+            DecisionCache(**kw)
+        except ValueError:
+            pass
+        else:
+            assert False, "%r should have been refused" % (kw, )
+
+    corsed = mw(Response("this is not a preflight response"), multi)
+    decision = corsed.selectPolicy("palim.woopy.com")
+    assert corsed.selectPolicy("palim.woopy.com") is decision, "cached decision should have been returned"
+
+    # what free threaded python uses
+    corsed.decisions = DecisionCache()
+    decision = corsed.shardedSelectPolicy("palim.woopy.com")
+    assert corsed.decisions.get(("palim.woopy.com", None)) == decision, "decision should have been cached"
+    assert corsed.shardedSelectPolicy("palim.woopy.com") is decision, "cached decision should have been returned"
+
+@with_setup(setup)
+def test_select_policy_override():
+    "a subclass can override selectPolicy"
+    class Sub(CORS):
+        def selectPolicy(self, origin, request_method=None):
+            return "deny", None
+
+    corsed = Sub(Response("this is not a preflight response"), origin="*")
+    assert corsed.selectPolicy("palim.woopy.com") == ("deny", None), "the overriding selectPolicy should have been used"
+
 @with_setup(setup)
 def test_non_preflight_are_not_answered():
     "requests that don't match preflight criteria are ignored"
@@ -156,6 +348,109 @@ def testdeny():
     assert "Access-Control-Expose-Headers" not in res.headers, "Header should not be in repsonse"
     assert "Vary" not in res.headers, "Header should not be in repsonse"
 
+@with_setup(setup)
+def test_reject_preflight():
+    "preflights no policy allows are answered with 403 if asked for"
+    cfg = {"policy":"pol1,pol2",
+           "pol1_origin":"*.woopy.com",
+           "pol1_methods":"*",
+           "pol2_origin":"*.palim.com",
+           "pol2_methods":"*",
+           "reject":"true"}
+    corsed = mw(Response("non preflight"), cfg)
+
+    preflight = prepRequest(preflight_headers, Origin="evil.net")
+    res = preflight.get_response(corsed)
+    assert res.status_int == 403, "Status should be 403 but was: %s" % res.status
+    assert res.body.decode("utf-8") == "", "Body must be empty but was:%s" % res.body
+    assert corsed.rejected["preflight"] == 1, "Rejection should have been counted"
+
+    for origin in ("palim.woopy.com", "woopy.palim.com"):
+        preflight = prepRequest(preflight_headers, Origin=origin)
+        res = preflight.get_response(corsed)
+        assert res.status_int == 204, "Status for %s should be 204 but was: %s" % (origin, res.status)
+    assert corsed.rejected["preflight"] == 1, "Allowed preflight must not be counted"
+
+    # without opt-in the old behaviour is kept
+    del cfg["reject"]
+    corsed = mw(Response("non preflight"), cfg)
+    res = prepRequest(preflight_headers, Origin="evil.net").get_response(corsed)
+    assert res.status_int == 204, "Status should be 204 but was: %s" % res.status
+
+    # direct config
+    corsed = CORS(Response("non preflight"), origin="*.woopy.com", methods="*", reject="true")
+    assert corsed.activepolicies == ["direct"], "direct config expected but policies are: %s" % corsed.activepolicies
+    for origin, expected in [("palim.woopy.com", 204), ("evil.net", 403)]:
+        res = prepRequest(preflight_headers, Origin=origin).get_response(corsed)
+        assert res.status_int == expected, "Status for %s should be %s but was: %s" % (origin, expected, res.status)
+
+@with_setup(setup)
+def test_reject_preflight_verbmatch():
+    "with verbmatch a preflight is only rejected if no policy allows origin and method"
+    cfg = verbmulti.copy()
+    cfg["policy"] = "pol1,pol2"
+    cfg["pol2_origin"] = "*.palim.com"
+    cfg["matchstrategy"] = "verbmatch"
+    cfg["reject"] = "true"
+    corsed = mw(Response("non preflight"), cfg)
+
+    for origin, method, expected in [("www.ourdomain.com", "PUT", 204),
+                                     ("www.palim.com", "GET", 204),
+                                     ("www.palim.com", "PUT", 403),
+                                     ("evil.net", "GET", 403)]:
+        preflight = prepRequest(preflight_headers, Origin=origin, Method=method)
+        res = preflight.get_response(corsed)
+        assert res.status_int == expected, "%s %s: expected %s but got %s" % (origin, method, expected, res.status)
+
+@with_setup(setup)
+def test_reject_request():
+    "disallowed actual requests are rejected only for the configured methods and paths"
+    cfg = {"policy":"pol",
+           "pol_origin":"*.woopy.com",
+           "pol_methods":"*",
+           "reject":"true",
+           "reject_methods":"POST, PUT",
+           "reject_paths":"/api/*"}
+    corsed = mw(Response("non preflight"), cfg)
+
+    for method, path, origin, expected in [("POST", "/api/items", "localhost", 403),
+                                           ("PUT", "/api/items", "localhost", 403),
+                                           ("GET", "/api/items", "localhost", 200),
+                                           ("POST", "/index.html", "localhost", 200),
+                                           ("POST", "/api/items", "palim.woopy.com", 200)]:
+        req = Request.blank(path, method=method, headers={"Origin":origin})
+        res = req.get_response(corsed)
+        assert res.status_int == expected, "%s %s from %s: expected %s but got %s" % (method, path, origin, expected, res.status)
+        if expected == 200:
+            assert res.body.decode("utf-8") == "non preflight", "Application should have been called"
+
+    assert corsed.rejected["request"] == 2, "Expected 2 rejections but got %s" % corsed.rejected["request"]
+
+    # no origin, no cors request
+    res = Request.blank("/api/items", method="POST").get_response(corsed)
+    assert res.status_int == 200, "Request without origin must not be rejected"
+
+@with_setup(setup)
+def test_reject_same_origin():
+    "same origin requests carrying an Origin header are never rejected"
+    cfg = {"policy":"pol",
+           "pol_origin":"https://partner.example.com",
+           "pol_methods":"*",
+           "reject":"true",
+           "reject_methods":"POST",
+           "reject_paths":"/api/*"}
+    corsed = mw(Response("non preflight"), cfg)
+
+    for url, origin, expected in [("https://mysite.example.com/api/items", "https://mysite.example.com", 200),
+                                  ("https://mysite.example.com:443/api/items", "https://MySite.example.com", 200),
+                                  ("http://mysite.example.com:8080/api/items", "http://mysite.example.com:8080", 200),
+                                  ("https://mysite.example.com/api/items", "http://mysite.example.com", 403),
+                                  ("https://mysite.example.com/api/items", "https://evil.example.com", 403),
+                                  ("https://mysite.example.com/api/items", "https://partner.example.com", 200)]:
+        req = Request.blank(url, method="POST", headers={"Origin":origin})
+        res = req.get_response(corsed)
+        assert res.status_int == expected, "POST %s from %s: expected %s but got %s" % (url, origin, expected, res.status)
+
 @with_setup(setup)
 def test_origin_policy_match():
     policy = free.copy()
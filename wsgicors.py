@@ -19,12 +19,212 @@
 # limitations under the License.
 
 import fnmatch
+import hashlib
+import json
+import sys
+import threading
 from functools import reduce
-from collections import namedtuple
+from collections import namedtuple, Counter
 try:
     from functools import lru_cache
 except ImportError:
     from backports.functools_lru_cache import lru_cache
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+# bump whenever the layout of Policy or the compilation changes, invalidates existing snapshots
+SNAPSHOT_VERSION = 4
+
+# the C implemented lru_cache is the fastest cache as long as the GIL serializes lookups anyway,
+# free threaded python uses a DecisionCache per middleware instead
+GIL_ENABLED = getattr(sys, "_is_gil_enabled", lambda: True)()
+
+# number of policy decisions cached
+DECISION_CACHE_SIZE = 1024
+
+Policy = namedtuple("Policy", ["name", "origin", "methods", "headers", "expose_headers", "credentials", "maxage", "match"])
+
+Origin = namedtuple("Origin", ["scheme", "host", "port"])
+
+def splitOrigin(origin):
+    "Splits an origin into scheme, host and port. Scheme and port are None if not given."
+    origin = origin.strip().lower()
+    scheme = None
+    if "://" in origin:
+        scheme, origin = origin.split("://", 1)
+    host, port = origin, None
+    if origin.startswith("[") and ":" in origin.partition("]")[0]:  # ipv6 literal
+        host, sep, rest = origin.partition("]")
+        host += sep
+        if rest.startswith(":"):
+            port = rest[1:]
+    elif ":" in origin:
+        host, port = origin.rsplit(":", 1)
+    return scheme, host, port
+
+@lru_cache(maxsize=1000)
+def parseOrigin(origin):
+    "Parses an origin into an Origin tuple with the host labels reversed. Returns None if the origin can't be parsed."
+    scheme, host, port = splitOrigin(origin)
+    if not host or (port is not None and not port.isdigit()):
+        return None
+    if host.startswith("["):
+        labels = (host, )
+    else:
+        labels = tuple(reversed(host.split(".")))
+    return Origin(scheme=scheme, host=labels, port=port)
+
+def isglob(s):
+    return "*" in s or "?" in s
+
+# A trie of reversed host labels is made of plain dicts, so it can be stored in a snapshot as is.
+# Labels never contain a dot, so keys starting with one hold the node's data:
+#   "."       a pattern ends here
+#   ".*"      a pattern with a leading "*" ends here, any subdomain matches
+#   ".globs"  list of [label pattern, node]
+# any other key is a label pointing to the next node.
+
+def addHost(node, labels):
+    "Adds the reversed host labels of a pattern to the trie starting at node."
+    for i, label in enumerate(labels):
+        if label == "*" and i == len(labels) - 1:
+            node[".*"] = True
+            return
+        if isglob(label):
+            globs = node.setdefault(".globs", [])
+            for pattern, child in globs:
+                if pattern == label:
+                    break
+            else:
+                child = {}
+                globs.append([label, child])
+        else:
+            child = node.setdefault(label, {})
+        node = child
+    node["."] = True
+
+def checkHost(node):
+    "Raises TypeError if node is not a trie as built by addHost, e.g. one read from a broken snapshot."
+    if not isinstance(node, dict):
+        raise TypeError("trie node must be a dict, not %r" % (node, ))
+    for key, value in node.items():
+        if key in (".", ".*"):
+            if value is not True:
+                raise TypeError("trie flag %r must be true, not %r" % (key, value))
+        elif key == ".globs":
+            if not isinstance(value, list):
+                raise TypeError("trie globs must be a list, not %r" % (value, ))
+            for entry in value:
+                if not (isinstance(entry, list) and len(entry) == 2 and isinstance(entry[0], string_types)):
+                    raise TypeError("trie glob must be a [pattern, node] pair, not %r" % (entry, ))
+                checkHost(entry[1])
+        else:
+            checkHost(value)
+
+def matchHost(node, labels, i=0):
+    "Tells whether the reversed host labels are matched by the trie starting at node."
+    if i == len(labels):
+        return "." in node
+    if ".*" in node:
+        return True
+    child = node.get(labels[i])
+    if child is not None and matchHost(child, labels, i + 1):
+        return True
+    for pattern, child in node.get(".globs", ()):
+        if fnmatch.fnmatchcase(labels[i], pattern) and matchHost(child, labels, i + 1):
+            return True
+    return False
+
+class OriginIndex(object):
+    """Matches origins against a list of origin patterns.
+
+    The patterns are indexed by scheme and port, each pointing to a trie of reversed host labels.
+    A pattern without scheme starting with "*" is indexed under scheme "*" and matches any scheme, as fnmatch did.
+    Patterns that can't be expressed that way are matched with fnmatch on the whole origin."""
+
+    def __init__(self, patterns=()):
+        self.hosts = {}  # (scheme, port) -> trie of reversed host labels
+        self.globs = []  # fallback patterns for fnmatch
+        for pattern in patterns:
+            self.add(pattern)
+
+    def asdict(self):
+        "The index as plain data for a snapshot."
+        return {"hosts": [[scheme, port, trie] for (scheme, port), trie in self.hosts.items()],
+                "globs": self.globs}
+
+    @classmethod
+    def fromdict(cls, data):
+        "Restores an index from the result of asdict without parsing any pattern. Raises TypeError or ValueError if data is malformed."
+        index = cls()
+        index.hosts = dict(((scheme, port), trie) for scheme, port, trie in data["hosts"])
+        for (scheme, port), trie in index.hosts.items():
+            if not all(x is None or isinstance(x, string_types) for x in (scheme, port)):
+                raise TypeError("scheme and port must be strings or null, not %r, %r" % (scheme, port))
+            checkHost(trie)
+        index.globs = list(data["globs"])
+        if not all(isinstance(x, string_types) for x in index.globs):
+            raise TypeError("glob patterns must be strings, not %r" % (index.globs, ))
+        return index
+
+    def add(self, pattern):
+        scheme, host, port = splitOrigin(pattern)
+        ipv6 = host.startswith("[") and host.endswith("]") and not isglob(host)
+        labels = [host] if ipv6 else list(reversed(host.split(".")))
+        if not host or (scheme and isglob(scheme)) or ("[" in host and not ipv6) \
+           or (port is not None and port != "*" and not port.isdigit()) \
+           or (isglob(labels[-1]) and labels[-1] != "*") \
+           or labels == ["*"]:  # like *woopy.com, https://* or *:*, the glob might span labels, port or scheme
+            self.globs.append(pattern.lower())
+            return
+        if scheme is None and labels[-1] == "*":
+            scheme = "*"
+        addHost(self.hosts.setdefault((scheme, port), {}), labels)
+
+    def match(self, origin):
+        parsed = parseOrigin(origin)
+        if parsed is not None:
+            ports = (parsed.port, "*") if parsed.port is not None else (None, )
+            for scheme in (parsed.scheme, "*"):
+                for port in ports:
+                    node = self.hosts.get((scheme, port))
+                    if node is not None and matchHost(node, parsed.host):
+                        return True
+        return CORS.matchlist(origin, self.globs)
+
+class DecisionCache(object):
+    """A bounded cache for policy decisions that doesn't serialize readers, used on free threaded python.
+
+    Entries are spread over shards by hash of the key. Lookups are plain dict reads without any lock,
+    inserts on a miss take the lock of their shard only. A full shard drops its oldest entry
+    (an arbitrary one on python < 3.7), hits don't update any recency information."""
+
+    def __init__(self, maxsize=DECISION_CACHE_SIZE, shards=16):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1, not %r" % (maxsize, ))
+        if shards < 1 or shards & (shards - 1):
+            raise ValueError("number of shards must be a power of 2, not %r" % (shards, ))
+        self.mask = shards - 1
+        self.shardsize = max(1, maxsize // shards)
+        self.shards = [{} for _ in range(shards)]
+        self.locks = [threading.Lock() for _ in range(shards)]
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def get(self, key):
+        return self.shards[hash(key) & self.mask].get(key)
+
+    def put(self, key, value):
+        idx = hash(key) & self.mask
+        shard = self.shards[idx]
+        with self.locks[idx]:
+            if key not in shard and len(shard) >= self.shardsize:
+                del shard[next(iter(shard))]
+            shard[key] = value
+        return value
 
 class CORS(object):
     "WSGI middleware allowing CORS requests to succeed"
@@ -40,10 +240,10 @@ class CORS(object):
 
     def __init__(self, application, cfg=None, **kw):
 
-        Policy = namedtuple("Policy", ["name", "origin", "methods", "headers", "expose_headers", "credentials", "maxage", "match"])
-
         self.policies = {}
         if kw and "policy" not in kw:  # direct config
+            kw = kw.copy()
+            cfg = dict((k, kw.pop(k)) for k in ("snapshot", "reject", "reject_methods", "reject_paths") if k in kw)
             self.activepolicies = ["direct"]
             self.matchstrategy = "firstmatch"
             self.policies["direct"]=kw
@@ -59,6 +259,31 @@ class CORS(object):
                     kw[k.split(prefix)[-1]] = v
                 self.policies[policy]=kw
 
+        # answer requests from origins no policy allows with 403: true or false
+        self.reject = cfg.get("reject", "false") == "true"
+        # comma separated list of methods, for which disallowed actual requests are rejected, or *
+        self.reject_methods = list(filter(None, map(lambda x: x.strip(), cfg.get("reject_methods", "").split(","))))
+        # space separated list of paths, possibly with filename wildcards "*" and "?"
+        self.reject_paths = list(filter(None, map(lambda x: x.strip(), cfg.get("reject_paths", "*").split(" "))))
+
+        snapshot = cfg.get("snapshot", None)
+        self.fingerprint = self.configFingerprint()
+        if not (snapshot and self.loadSnapshot(snapshot)):
+            self.compilePolicies()
+
+        self.rejected = Counter()
+        self.rejectedlock = threading.Lock()
+        self.decisions = None if GIL_ENABLED else DecisionCache()
+        self.application = application
+
+    def configFingerprint(self):
+        "A hash over the (uncompiled) policy configuration, used to tell whether a snapshot is still valid."
+        cfg = [SNAPSHOT_VERSION, self.matchstrategy, self.activepolicies, [self.policies[pol] for pol in self.activepolicies]]
+        return hashlib.sha1(json.dumps(cfg, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def compilePolicies(self):
+        "Turns the raw policy configuration into Policy tuples and their OriginIndex."
+        self.matchers = {}
         for policy in self.activepolicies:
             kw = self.policies[policy]
             # copy or * or a space separated list of hostnames, possibly with filename wildcards "*" and "?"
@@ -85,6 +310,7 @@ class CORS(object):
                        maxage=pol_maxage, 
                        match=match)
             self.policies[policy] = pol
+            self.matchers[policy] = OriginIndex(match)
 
             # a little sanity check
             configkeys="origin,methods,headers,expose_headers,credentials,maxage".split(",")
@@ -95,14 +321,60 @@ class CORS(object):
                     print("The policy '%s' was referenced but has no value for 'origin' set. Nothing good can come from this." % policy)
                 elif policy != "deny":
                     print("The policy '%s' was referenced but hasn't defined any keys. This might be an case sensitivity issue." % policy)
-                    
-
-
-        self.application = application
 
-    @lru_cache(maxsize=200)
-    def selectPolicy(self, origin, request_method=None):
-        "Based on the matching strategy and the origin and optionally the requested method a tuple of policyname and origin to pass back is returned."
+    def saveSnapshot(self, filename):
+        "Writes the compiled policies to filename, so they can be loaded via the snapshot keyword later on."
+        snap = {"fingerprint": self.fingerprint,
+                "policies": [self.policies[pol]._asdict() for pol in self.activepolicies],
+                "matchers": dict((pol, self.matchers[pol].asdict()) for pol in self.activepolicies)}
+        with open(filename, "w") as f:
+            json.dump(snap, f, separators=(",", ":"))
+
+    def loadSnapshot(self, filename):
+        "Loads compiled policies from filename. Returns False if the snapshot is unreadable or does not match the configuration."
+        try:
+            with open(filename) as f:
+                snap = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            print("The snapshot '%s' could not be loaded (%s), compiling the configuration instead." % (filename, e))
+            return False
+
+        if not isinstance(snap, dict) or snap.get("fingerprint") != self.fingerprint:
+            print("The snapshot '%s' does not match the configuration, compiling the configuration instead." % filename)
+            return False
+
+        try:
+            policies = dict((pol["name"], Policy(**pol)) for pol in snap["policies"])
+            matchers = dict((pol, OriginIndex.fromdict(snap["matchers"][pol])) for pol in self.activepolicies)
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            print("The snapshot '%s' is malformed (%r), compiling the configuration instead." % (filename, e))
+            return False
+        if sorted(policies) != sorted(self.activepolicies):
+            print("The snapshot '%s' does not hold the configured policies, compiling the configuration instead." % filename)
+            return False
+
+        self.policies.update(policies)
+        self.matchers = matchers
+        return True
+
+    @lru_cache(maxsize=DECISION_CACHE_SIZE)
+    def lruSelectPolicy(self, origin, request_method=None):
+        "selectPolicy with the GIL enabled."
+        return self.matchPolicy(origin, request_method)
+
+    def shardedSelectPolicy(self, origin, request_method=None):
+        "selectPolicy on free threaded python, caches in self.decisions."
+        key = (origin, request_method)
+        decision = self.decisions.get(key)
+        if decision is None:
+            decision = self.decisions.put(key, self.matchPolicy(origin, request_method))
+        return decision
+
+    # Based on the matching strategy and the origin and optionally the requested method a tuple of policyname and origin to pass back is returned.
+    selectPolicy = lruSelectPolicy if GIL_ENABLED else shardedSelectPolicy
+
+    def matchPolicy(self, origin, request_method=None):
+        "Uncached version of selectPolicy."
         ret_origin = None
         policyname = None
         if self.matchstrategy in ("firstmatch", "verbmatch"):
@@ -116,7 +388,7 @@ class CORS(object):
                     if policy.methods != "*" and not CORS.matchlist(request_method, policy.methods, case_sensitive=True):
                         continue
                 if origin and policy.match:
-                    if CORS.matchlist(origin, policy.match):
+                    if self.matchers[pol].match(origin):
                         ret_origin = origin
                 elif policy.origin == "copy":
                     ret_origin = origin
@@ -126,6 +398,38 @@ class CORS(object):
                     break
         return policyname, ret_origin 
 
+    @staticmethod
+    def sameOrigin(environ):
+        "Tells whether the Origin header names the origin the request was sent to, browsers send it on same origin requests too."
+        scheme = environ.get("wsgi.url_scheme", "http")
+        host = environ.get("HTTP_HOST")
+        if not host:
+            host = "%s:%s" % (environ.get("SERVER_NAME", ""), environ.get("SERVER_PORT", ""))
+        default = ":443" if scheme == "https" else ":80"
+        if host.endswith(default):
+            host = host[:-len(default)]
+        origin = environ["HTTP_ORIGIN"]
+        if origin.endswith(default):
+            origin = origin[:-len(default)]
+        return origin.lower() == ("%s://%s" % (scheme, host)).lower()
+
+    def rejectRequest(self, environ, ret_origin, preflight):
+        "Tells whether a cross origin request of an origin that no policy allows should be answered with 403 right away."
+        if ret_origin or not self.reject or CORS.sameOrigin(environ):
+            return False
+        if preflight:
+            return True
+        request_method = environ["REQUEST_METHOD"]
+        if "*" not in self.reject_methods and request_method not in self.reject_methods:
+            return False
+        return CORS.matchlist(environ.get("PATH_INFO", ""), self.reject_paths, case_sensitive=True)
+
+    def rejectResponse(self, kind, start_response):
+        with self.rejectedlock:
+            self.rejected[kind] += 1
+        start_response('403 Forbidden', [('Content-Length', '0')])
+        return []
+
     def __call__(self, environ, start_response):
 
         # we handle the request ourself only if it is identified as a prefilght request
@@ -137,6 +441,9 @@ class CORS(object):
             ac_request_method = environ.get("HTTP_ACCESS_CONTROL_REQUEST_METHOD")
             policyname, origin = self.selectPolicy(orig, ac_request_method)
 
+            if self.rejectRequest(environ, origin, True):
+                return self.rejectResponse("preflight", start_response)
+
             if policyname == "deny":
                 pass
             else:
@@ -176,6 +483,9 @@ class CORS(object):
         request_method = environ['REQUEST_METHOD']
         policyname, ret_origin = self.selectPolicy(orig, request_method)
 
+        if orig and self.rejectRequest(environ, ret_origin, False):
+            return self.rejectResponse("request", start_response)
+
         if orig and policyname != "deny":
             def custom_start_response(status, headers, exc_info=None):
 